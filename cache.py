@@ -0,0 +1,133 @@
+"""
+Response Cache Helpers
+
+Small key/value cache for pre-serialized JSON responses. Uses Redis when
+REDIS_URL is set so every worker shares one cache (and one invalidation);
+otherwise falls back to an in-process store.
+
+Each key carries a generation number (stored under "<key>:gen") that
+cache_delete bumps, and every cached value records the generation it was
+fetched under. A value from a fetch that was already running when the key
+was invalidated is therefore never served afterwards.
+"""
+
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+_redis: Any = None
+_local: Dict[str, Tuple[float, int, bytes]] = {}
+_local_gen: Dict[str, int] = {}
+
+redis_url = os.getenv("REDIS_URL")
+
+# The in-process store only sees invalidations from its own worker, so with
+# several workers (WEB_CONCURRENCY > 1) its TTLs are capped to bound how long
+# other workers can serve a stale list.
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+LOCAL_MAX_TTL = 2
+
+if redis_url:
+    import redis.asyncio as aioredis
+    from redis.exceptions import RedisError
+
+    _redis = aioredis.from_url(redis_url)
+elif WORKERS > 1:
+    logger.warning(
+        "REDIS_URL not set with %d workers; response cache TTLs capped at %ds",
+        WORKERS, LOCAL_MAX_TTL,
+    )
+
+
+async def close_cache() -> None:
+    """Close the Redis connection pool (called on app shutdown)"""
+    if _redis is not None:
+        await _redis.aclose()
+
+
+def _pack(gen: int, data: bytes) -> bytes:
+    return b"%d:%b" % (gen, data)
+
+
+def _unpack(value: bytes) -> Tuple[int, bytes]:
+    gen, _, data = value.partition(b":")
+    return int(gen), data
+
+
+async def _lookup(key: str) -> Tuple[Optional[int], Optional[bytes]]:
+    """Return (current generation, cached bytes or None) for key.
+
+    The generation is None when Redis is unreachable, meaning the cache
+    should be bypassed for this request.
+    """
+    if _redis is not None:
+        try:
+            # One round trip on a hit: the generation and the value together
+            gen_raw, value = await _redis.mget(f"{key}:gen", key)
+        except RedisError as e:
+            logger.warning("Cache read of %s failed: %s", key, e)
+            return None, None
+        gen = int(gen_raw or 0)
+        if value is not None:
+            cached_gen, data = _unpack(value)
+            if cached_gen == gen:
+                return gen, data
+        return gen, None
+    gen = _local_gen.get(key, 0)
+    entry = _local.get(key)
+    if entry is not None and entry[1] == gen and entry[0] >= time.monotonic():
+        return gen, entry[2]
+    return gen, None
+
+
+async def _store(key: str, gen: int, data: bytes, ttl: int) -> None:
+    """Cache data for key as belonging to generation gen"""
+    if _redis is not None:
+        try:
+            await _redis.setex(key, ttl, _pack(gen, data))
+        except RedisError as e:
+            logger.warning("Cache write of %s failed: %s", key, e)
+        return
+    if _local_gen.get(key, 0) != gen:
+        return  # invalidated while the value was being fetched
+    if WORKERS > 1:
+        ttl = min(ttl, LOCAL_MAX_TTL)
+    _local[key] = (time.monotonic() + ttl, gen, data)
+
+
+async def cache_delete(*keys: str) -> None:
+    """Invalidate cached_json keys by bumping their generation"""
+    if _redis is not None:
+        try:
+            async with _redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.incr(f"{key}:gen")
+                    pipe.delete(key)
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(
+                "Cache invalidation of %s failed; stale data may be served until it expires: %s",
+                ", ".join(keys), e,
+            )
+        return
+    for key in keys:
+        _local.pop(key, None)
+        _local_gen[key] = _local_gen.get(key, 0) + 1
+
+
+async def cached_json(key: str, ttl: int, producer: Callable[[], Awaitable]) -> bytes:
+    """Return cached JSON bytes for key, calling producer and caching on a miss"""
+    gen, data = await _lookup(key)
+    if data is None:
+        data = orjson.dumps(await producer())
+        if gen is not None:
+            await _store(key, gen, data, ttl)
+    return data
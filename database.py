@@ -5,51 +5,106 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
 from datetime import datetime, timezone
+import asyncio
+import logging
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import Any, List, Optional, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
-_client = None
-db = None
+logger = logging.getLogger(__name__)
+
+# Motor builds its classes at runtime, so they cannot be used as static types
+_client: Any = None
+db: Any = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Motor connects lazily, so the client can be built at import time and
+    # bound to the running event loop on first use.
+    _client = AsyncIOMotorClient(database_url)
     db = _client[database_name]
 
+
+def close_client() -> None:
+    """Close the MongoDB client (called on app shutdown)"""
+    if _client is not None:
+        _client.close()
+
+
+async def _create_index(collection_name: str, keys, **kwargs) -> None:
+    """Create one index, logging failures instead of raising"""
+    try:
+        await db[collection_name].create_index(keys, **kwargs)
+    except PyMongoError as e:
+        logger.error("Could not create index %s on %s: %s", keys, collection_name, e)
+
+
+async def ensure_indexes() -> None:
+    """Create the indexes the API queries rely on (idempotent).
+
+    Runs as a background task at startup. Failures are logged rather than
+    raised, and the database problem is reported on /test.
+    """
+    if db is None:
+        return
+    # Built concurrently so an unreachable server costs one selection timeout.
+    # The unique email index fails on existing duplicate emails; those must be
+    # merged or removed before it can build (see README).
+    await asyncio.gather(
+        _create_index("member", "email", unique=True),
+        _create_index("message", [("channel", ASCENDING), ("created_at", DESCENDING)]),
+    )
+
+
+def _strify(docs: List[dict]) -> List[dict]:
+    """Convert each document's ObjectId ``_id`` to a string in place"""
+    for d in docs:
+        if "_id" in d:
+            d["_id"] = str(d["_id"])
+    return docs
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]) -> str:
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
-    # Convert Pydantic model to dict if needed
+    # Convert Pydantic model to dict if needed; dicts are copied
     if isinstance(data, BaseModel):
         data_dict = data.model_dump()
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
+async def get_documents(collection_name: str, filter_dict: Optional[dict] = None, limit: Optional[int] = None,
+                        projection: Optional[dict] = None, sort: Optional[list] = None) -> List[dict]:
+    """Get documents from collection, optionally projected and sorted server-side.
+
+    ``_id`` values are returned as strings so results can be serialized as-is.
+    """
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
     
-    cursor = db[collection_name].find(filter_dict or {})
+    cursor = db[collection_name].find(filter_dict or {}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return _strify(await cursor.to_list(length=limit or None))
@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration for production
+
+Run with: gunicorn main:app -c gunicorn_conf.py
+
+One uvicorn worker (event loop) per CPU core. The worker count is exported
+to the app as WEB_CONCURRENCY so its per-process caches can shorten their
+TTLs when invalidations cannot reach the other workers.
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = 5
+raw_env = [f"WEB_CONCURRENCY={workers}"]